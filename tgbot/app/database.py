@@ -3,13 +3,25 @@ import os
 import time
 
 from aiokit import AioThing
+from lru import LRU
 
 from tgbot.app.aiosqlite_wrapper import AioSqlite
 
 
 class Database(AioThing):
-    def __init__(self, data_directory):
+    def __init__(
+        self,
+        data_directory,
+        telegram_files_cache_size: int = 10000,
+        telegram_files_cache_ttl: float = 3600.0,
+        telegram_files_negative_cache_ttl: float = 60.0,
+    ):
         super().__init__()
+        # cid -> {bot_name: (file_id, expires_at)}, misses are cached as `None` for a shorter time.
+        # Entries are grouped by cid, so invalidation of a cid for all bots is a single lookup
+        self.telegram_files_cache = LRU(telegram_files_cache_size)
+        self.telegram_files_cache_ttl = telegram_files_cache_ttl
+        self.telegram_files_negative_cache_ttl = telegram_files_negative_cache_ttl
         self.bots_db_wrapper = AioSqlite(os.path.join(data_directory, "bots.db"))
         self.starts.append(self.bots_db_wrapper)
 
@@ -85,17 +97,38 @@ class Database(AioThing):
         """)
 
     async def get_cached_file(self, bot_name, cid):
+        cached = self.telegram_files_cache.get(cid, {}).get(bot_name)
+        if cached is not None:
+            file_id, expires_at = cached
+            if time.monotonic() < expires_at:
+                return file_id
+        file_id = None
         async with self.bots_db_wrapper.db.execute("""
         select file_id from telegram_files where bot_name = ? and cid = ?
         """, (bot_name, cid)) as cursor:
             async for row in cursor:
-                return row['file_id']
+                file_id = row['file_id']
+                break
+        ttl = self.telegram_files_cache_ttl if file_id else self.telegram_files_negative_cache_ttl
+        self._cache_file(bot_name, cid, file_id, ttl)
+        return file_id
 
     async def put_cached_file(self, bot_name, cid, file_id):
         await self.bots_db_wrapper.db.execute("""
         INSERT OR IGNORE into telegram_files(bot_name, cid, file_id) VALUES (?, ?, ?)
         """, (bot_name, cid, file_id))
         await self.bots_db_wrapper.db.commit()
+        # `INSERT OR IGNORE` keeps the existing row, so the cache is only filled if it has nothing yet
+        cached = self.telegram_files_cache.get(cid, {}).get(bot_name)
+        if cached is None or cached[0] is None:
+            self._cache_file(bot_name, cid, file_id, self.telegram_files_cache_ttl)
+
+    def _cache_file(self, bot_name, cid, file_id, ttl):
+        cached_files = self.telegram_files_cache.get(cid)
+        if cached_files is None:
+            cached_files = {}
+            self.telegram_files_cache[cid] = cached_files
+        cached_files[bot_name] = (file_id, time.monotonic() + ttl)
 
     async def delete_cached_file(self, cid):
         logging.getLogger('statbox').info({
@@ -107,6 +140,7 @@ class Database(AioThing):
         delete from telegram_files where cid = ?
         """, (cid,))
         await self.bots_db_wrapper.db.commit()
+        self.telegram_files_cache.pop(cid, None)
 
     async def add_upload(self, user_id, message_id, internal_id):
         await self.users_db_wrapper.db.execute("""
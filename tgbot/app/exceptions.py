@@ -34,6 +34,11 @@ class DownloadError(BaseError):
     code = 'download_error'
 
 
+class FilesizeMismatchError(BaseError):
+    level = logging.WARNING
+    code = 'filesize_mismatch_error'
+
+
 class InvalidSearchError(BaseError):
     def __init__(self, search):
         self.search = search
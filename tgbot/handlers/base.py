@@ -40,6 +40,8 @@ def get_language(event: events.ChatAction, chat):
 
 
 class LongTask:
+    __slots__ = ('application', 'request_context', 'document_holder', 'task')
+
     def __init__(
         self,
         application,
@@ -1,4 +1,5 @@
 import asyncio
+import re
 import time
 
 import aiohttp
@@ -6,23 +7,20 @@ from aiobaseclient.exceptions import (
     ServiceUnavailableError,
     TemporaryError,
 )
-from izihawa_utils.common import filter_none
+from lru import LRU
 from telethon import (
     Button,
     events,
 )
 from telethon.errors import rpcerrorlist
 from telethon.tl.types import DocumentAttributeFilename
-from tenacity import (
-    retry,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_fixed,
-)
 
 from library.telegram.base import RequestContext
 from library.telegram.utils import safe_execution
-from tgbot.app.exceptions import DownloadError
+from tgbot.app.exceptions import (
+    DownloadError,
+    FilesizeMismatchError,
+)
 from tgbot.translations import t
 from tgbot.views.telegram.base_holder import BaseTelegramDocumentHolder
 from tgbot.views.telegram.common import (
@@ -40,11 +38,18 @@ from .base import (
 )
 
 
+# Captions of recently sent documents keyed by (cid, language), stored with their expiration time
+caption_cache = LRU(1024)
+# Recently requested documents keyed by cid, repeated clicks on the same button are served from here
+document_cache = LRU(256)
+
+
 async def download_thumb(isbns, timeout=5.0):
     if not isbns:
         return
     try:
-        return await asyncio.wait_for(do_download_thumb(isbns[0], timeout), timeout)
+        async with asyncio.timeout(timeout):
+            return await do_download_thumb(isbns[0], timeout)
     except (asyncio.TimeoutError, asyncio.CancelledError):
         return
 
@@ -57,7 +62,101 @@ async def do_download_thumb(isbn, timeout=5.0):
                 return data
 
 
+class DocumentStream:
+    """
+    Async file-like object over IPFS chunks that is consumed by Telethon part by part,
+    so downloading from IPFS and uploading to Telegram overlap without buffering the whole file.
+    IPFS chunks are prefetched by a producer task into a bounded queue that applies backpressure
+    when Telegram uploads slower than IPFS delivers.
+    The document must be exactly `filesize` bytes long, otherwise `FilesizeMismatchError` is raised
+    before the last part is returned, so Telethon never finishes the upload of a broken file.
+    `timeout` limits the total time spent waiting for IPFS, the upload itself is not limited
+    """
+    def __init__(self, chunks, name, filesize, progress_bar=None, max_queued_chunks=16, timeout=None):
+        self.chunks = chunks
+        self.name = name
+        self.filesize = filesize
+        self.progress_bar = progress_bar
+        self.timeout = timeout
+        self.position = 0
+        self.is_exhausted = False
+        self.exhausted_at = None
+        self._buffer = bytearray()
+        self._queue = asyncio.Queue(maxsize=max_queued_chunks)
+        self._producer = None
+
+    def start(self):
+        self._producer = asyncio.create_task(self._produce())
+        return self
+
+    async def close(self):
+        if self._producer:
+            self._producer.cancel()
+            await asyncio.gather(self._producer, return_exceptions=True)
+
+    async def _produce(self):
+        # Time blocked on the full queue is spent waiting for Telegram, so only pulls from IPFS are counted
+        time_left = self.timeout
+        try:
+            while True:
+                pulled_at = time.monotonic()
+                try:
+                    async with asyncio.timeout(time_left):
+                        chunk = await anext(self.chunks)
+                except StopAsyncIteration:
+                    break
+                if time_left is not None:
+                    time_left -= time.monotonic() - pulled_at
+                await self._queue.put(chunk)
+        except Exception as e:
+            await self._queue.put(e)
+        else:
+            self.exhausted_at = time.monotonic()
+            await self._queue.put(None)
+        finally:
+            # Releases the IPFS response if the producer has been stopped in the middle of the document
+            await self.chunks.aclose()
+
+    async def _fill(self, n):
+        while not self.is_exhausted and (n < 0 or len(self._buffer) < n):
+            chunk = await self._queue.get()
+            if chunk is None:
+                self.is_exhausted = True
+            elif isinstance(chunk, Exception):
+                self.is_exhausted = True
+                raise chunk
+            else:
+                self._buffer.extend(chunk)
+
+    async def is_empty(self):
+        await self._fill(1)
+        return not self._buffer
+
+    def is_complete(self):
+        return self.is_exhausted and not self._buffer and self.position == self.filesize
+
+    async def read(self, n=-1):
+        remaining = self.filesize - self.position
+        if n < 0 or n > remaining:
+            n = remaining
+        # One byte over the part is awaited to find out whether the document is longer than declared
+        await self._fill(n + 1)
+        part = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        self.position += len(part)
+        if (
+            (self.position == self.filesize and self._buffer)
+            or (self.is_exhausted and not self._buffer and self.position < self.filesize)
+        ):
+            raise FilesizeMismatchError(position=self.position + len(self._buffer), filesize=self.filesize)
+        if self.progress_bar:
+            await self.progress_bar.callback(self.position, self.filesize)
+        return part
+
+
 class DownloadTask(LongTask):
+    __slots__ = ('download_link', 'related_channel')
+
     def __init__(
         self,
         application,
@@ -67,6 +166,7 @@ class DownloadTask(LongTask):
     ):
         super().__init__(application, request_context, document_holder)
         self.download_link = download_link
+        self.related_channel = application.config['telegram']['related_channel']
 
     @property
     def task_id(self):
@@ -78,11 +178,14 @@ class DownloadTask(LongTask):
 
     async def long_task(self, request_context: RequestContext):
         throttle_secs = 3.0
+        telegram_client = self.application.get_telegram_client(request_context.bot_name)
+        chat_id = request_context.chat['chat_id']
+        language = request_context.chat['language']
 
         async def _on_fail():
-            await self.application.get_telegram_client(request_context.bot_name).send_message(
-                request_context.chat['chat_id'],
-                t('MAINTENANCE', request_context.chat['language']).format(
+            await telegram_client.send_message(
+                chat_id,
+                t('MAINTENANCE', language).format(
                     error_picture_url=self.application.config['application']['error_picture_url']
                 ),
                 buttons=request_context.personal_buttons()
@@ -90,7 +193,7 @@ class DownloadTask(LongTask):
 
         telegram_file_id = await self.application.database.get_cached_file(request_context.bot_name, self.download_link['cid'])
         if not telegram_file_id:
-            telegram_file_id = self.application.get_telegram_client(request_context.bot_name).get_cached_file_id(self.download_link['cid'])
+            telegram_file_id = telegram_client.get_cached_file_id(self.download_link['cid'])
         if telegram_file_id:
             async with safe_execution(error_log=request_context.error_log):
                 await self.send_file(
@@ -98,6 +201,7 @@ class DownloadTask(LongTask):
                     download_link=self.download_link,
                     file=telegram_file_id,
                     request_context=request_context,
+                    telegram_client=telegram_client,
                 )
                 request_context.statbox(action='cache_hit')
                 return
@@ -106,68 +210,98 @@ class DownloadTask(LongTask):
             error_log=request_context.error_log,
             on_fail=_on_fail,
         ):
-            start_time = time.time()
+            start_time = time.monotonic()
             filename = self.document_holder.get_purified_name(self.download_link) + '.' + self.download_link['extension']
+            filesize = self.download_link.get('filesize')
+            banner = t('LOOKING_AT', language)
+            header = f'⬇️ {filename}'
             progress_bar_download = ProgressBar(
-                telegram_client=self.application.get_telegram_client(request_context.bot_name),
+                telegram_client=telegram_client,
                 request_context=request_context,
-                banner=t("LOOKING_AT", request_context.chat['language']),
-                header=f'⬇️ {filename}',
-                tail_text=t('TRANSMITTED_FROM', request_context.chat['language']),
+                banner=banner,
+                header=header,
+                tail_text=t('TRANSMITTED_FROM', language),
                 source='IPFS',
                 throttle_secs=throttle_secs,
                 last_call=start_time,
             )
+            thumb_task = None
             try:
                 thumb_task = asyncio.create_task(download_thumb(self.document_holder.isbns))
-                file = await asyncio.wait_for(self.download_document(
-                    cid=self.download_link['cid'],
-                    progress_bar=progress_bar_download,
-                    request_context=request_context,
-                    filesize=self.download_link.get('filesize'),
-                ), timeout=600)
-                if file:
-                    request_context.statbox(
-                        action='downloaded',
-                        duration=time.time() - start_time,
-                        len=len(file),
-                    )
-                    progress_bar_upload = ProgressBar(
-                        telegram_client=self.application.get_telegram_client(request_context.bot_name),
-                        request_context=request_context,
-                        message=progress_bar_download.message,
-                        banner=t("LOOKING_AT", request_context.chat["language"]),
-                        header=f'⬇️ {filename}',
-                        tail_text=t('UPLOADED_TO_TELEGRAM', request_context.chat["language"]),
-                        throttle_secs=throttle_secs,
-                        last_call=progress_bar_download.last_call,
-                    )
-                    uploaded_message = await self.send_file(
-                        document_holder=self.document_holder,
-                        download_link=self.download_link,
-                        file=file,
-                        progress_callback=progress_bar_upload.callback,
-                        request_context=self.request_context,
-                        thumb=await thumb_task
-                    )
-                    asyncio.create_task(self.application.database.put_cached_file(
+                uploaded_message = None
+                is_streamed = False
+                if filesize:
+                    try:
+                        uploaded_message = await self.stream_document(
+                            document_holder=self.document_holder,
+                            download_link=self.download_link,
+                            filename=filename,
+                            filesize=filesize,
+                            progress_bar=progress_bar_download,
+                            request_context=request_context,
+                            telegram_client=telegram_client,
+                            thumb_task=thumb_task,
+                            start_time=start_time,
+                        )
+                        is_streamed = True
+                    except FilesizeMismatchError as e:
+                        # Filesizes in the index may be inaccurate, such documents are sent through the buffered path
+                        request_context.error_log(e)
+                if not is_streamed:
+                    async with asyncio.timeout(600):
+                        file = await self.download_document(
+                            cid=self.download_link['cid'],
+                            progress_bar=progress_bar_download,
+                            request_context=request_context,
+                            filesize=filesize,
+                        )
+                    if file:
+                        request_context.statbox(
+                            action='downloaded',
+                            duration=time.monotonic() - start_time,
+                            len=len(file),
+                        )
+                        progress_bar_upload = ProgressBar(
+                            telegram_client=telegram_client,
+                            request_context=request_context,
+                            message=progress_bar_download.message,
+                            banner=banner,
+                            header=header,
+                            tail_text=t('UPLOADED_TO_TELEGRAM', language),
+                            throttle_secs=throttle_secs,
+                            last_call=progress_bar_download.last_call,
+                        )
+                        uploaded_message = await self.send_file(
+                            document_holder=self.document_holder,
+                            download_link=self.download_link,
+                            file=file,
+                            filename=filename,
+                            progress_callback=progress_bar_upload.callback,
+                            request_context=self.request_context,
+                            telegram_client=telegram_client,
+                            thumb=await thumb_task
+                        )
+                if uploaded_message:
+                    # The upload is the most expensive step, so its file id is stored even if the task is canceled now
+                    await asyncio.shield(self.application.database.put_cached_file(
                         request_context.bot_name,
                         self.download_link['cid'],
                         uploaded_message.file.id,
                     ))
                     request_context.statbox(
                         action='uploaded',
-                        duration=time.time() - start_time,
+                        duration=time.monotonic() - start_time,
                         file_id=uploaded_message.file.id
                     )
                 else:
                     request_context.statbox(
                         action='not_found',
-                        duration=time.time() - start_time,
+                        duration=time.monotonic() - start_time,
                     )
                     await self.respond_not_found(
                         request_context=request_context,
                         document_holder=self.document_holder,
+                        telegram_client=telegram_client,
                     )
             except (ServiceUnavailableError, DownloadError) as e:
                 request_context.error_log(e)
@@ -175,66 +309,200 @@ class DownloadTask(LongTask):
             except ProgressBarLostMessageError:
                 self.request_context.statbox(
                     action='user_canceled',
-                    duration=time.time() - start_time,
+                    duration=time.monotonic() - start_time,
                 )
             except asyncio.CancelledError:
                 pass
             finally:
-                messages = filter_none([progress_bar_download.message])
-                if messages:
+                # Sibling tasks must not outlive the download, whatever way it has ended
+                if thumb_task:
+                    thumb_task.cancel()
+                if progress_bar_download.message is not None:
                     async with safe_execution(error_log=request_context.error_log):
-                        await self.application.get_telegram_client(request_context.bot_name).delete_messages(
-                            request_context.chat['chat_id'],
-                            messages
+                        await telegram_client.delete_messages(
+                            chat_id,
+                            [progress_bar_download.message]
                         )
                 request_context.debug_log(action='deleted_progress_message')
 
-    async def respond_not_found(self, request_context: RequestContext, document_holder):
-        return await self.application.get_telegram_client(request_context.bot_name).send_message(
+    async def respond_not_found(self, request_context: RequestContext, document_holder, telegram_client=None):
+        telegram_client = telegram_client or self.application.get_telegram_client(request_context.bot_name)
+        language = request_context.chat['language']
+        return await telegram_client.send_message(
             request_context.chat['chat_id'],
-            t("SOURCES_UNAVAILABLE", request_context.chat["language"]).format(
-                document=document_holder.doi or document_holder.view_builder(
-                    request_context.chat["language"]).add_title(bold=False).build()
+            t("SOURCES_UNAVAILABLE", language).format(
+                document=document_holder.doi or document_holder.view_builder(language).add_title(bold=False).build()
             ),
             buttons=request_context.personal_buttons()
         )
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_fixed(5.0),
-        retry=retry_if_exception_type(TemporaryError),
-        reraise=True,
-    )
-    async def download_document(self, cid, request_context, progress_bar=None, filesize=None):
+    async def stream_document(self, **kwargs):
+        # Every attempt reopens the document as a consumed stream cannot be uploaded again
+        for _ in range(2):
+            try:
+                return await self.do_stream_document(**kwargs)
+            except TemporaryError:
+                await asyncio.sleep(5.0)
+            except (rpcerrorlist.TimeoutError, ValueError):
+                pass
+        return await self.do_stream_document(**kwargs)
+
+    async def do_stream_document(
+        self,
+        document_holder,
+        download_link,
+        filename,
+        filesize,
+        request_context,
+        telegram_client,
+        thumb_task,
+        start_time,
+        progress_bar=None,
+    ):
+        stream = await self.open_document_stream(
+            cid=download_link['cid'],
+            name=filename,
+            filesize=filesize,
+            request_context=request_context,
+            progress_bar=progress_bar,
+        )
+        if not stream:
+            return
+        try:
+            # Telethon pulls the stream while uploading, so the download bar reflects both transfers
+            uploaded_message = await self.do_send_file(
+                document_holder=document_holder,
+                download_link=download_link,
+                file=stream,
+                file_size=filesize,
+                filename=filename,
+                request_context=request_context,
+                telegram_client=telegram_client,
+                thumb=await thumb_task,
+            )
+        finally:
+            await stream.close()
+        if not stream.is_complete():
+            raise FilesizeMismatchError(position=stream.position, filesize=filesize)
+        request_context.statbox(
+            action='downloaded',
+            duration=stream.exhausted_at - start_time,
+            len=stream.position,
+        )
+        return uploaded_message
+
+    async def open_document_stream(self, cid, name, request_context, filesize, progress_bar=None):
+        request_context.statbox(
+            action='do_request',
+            cid=cid,
+            is_streaming=True,
+        )
+        if progress_bar:
+            await progress_bar.show_banner()
+        stream = DocumentStream(
+            chunks=self.application.ipfs_http_client.get_iter(cid),
+            name=name,
+            filesize=filesize,
+            progress_bar=progress_bar,
+            timeout=600.0,
+        ).start()
+        try:
+            if await stream.is_empty():
+                await stream.close()
+                return
+        except BaseException:
+            await stream.close()
+            raise
+        return stream
+
+    async def download_document(self, **kwargs):
+        for _ in range(2):
+            try:
+                return await self.do_download_document(**kwargs)
+            except TemporaryError:
+                await asyncio.sleep(5.0)
+        return await self.do_download_document(**kwargs)
+
+    async def do_download_document(
+        self,
+        cid,
+        request_context,
+        progress_bar=None,
+        filesize=None,
+        progress_report_bytes=256 * 1024,
+        progress_report_secs=0.5,
+    ):
         request_context.statbox(
             action='do_request',
             cid=cid,
         )
         if progress_bar:
             await progress_bar.show_banner()
-        collected = bytearray()
+        # Chunks are joined once in the end: Telethon requires `bytes`, so growing a `bytearray`
+        # would cost reallocations and one more full copy
+        chunks = []
+        collected = 0
+        # Progress is reported in batches as IPFS may yield thousands of small chunks
+        reported = 0
+        reported_at = time.monotonic()
         async for chunk in self.application.ipfs_http_client.get_iter(cid):
-            collected.extend(chunk)
-            if progress_bar:
-                await progress_bar.callback(len(collected), filesize)
-        return bytes(collected)
-
-    @retry(
-        reraise=True,
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type((rpcerrorlist.TimeoutError, ValueError)),
-    )
-    async def send_file(
+            chunks.append(chunk)
+            collected += len(chunk)
+            if progress_bar and (
+                collected - reported >= progress_report_bytes
+                or time.monotonic() - reported_at > progress_report_secs
+            ):
+                await progress_bar.callback(collected, filesize)
+                reported = collected
+                reported_at = time.monotonic()
+        if progress_bar and collected != reported:
+            await progress_bar.callback(collected, filesize)
+        return b''.join(chunks)
+
+    def get_caption(self, document_holder, download_link, language, ttl=60.0):
+        cache_key = (download_link['cid'], language)
+        cached = caption_cache.get(cache_key)
+        if cached is not None:
+            caption, expires_at = cached
+            if time.monotonic() < expires_at:
+                return caption
+        short_abstract = (
+            document_holder.view_builder(language)
+            .add_short_description()
+            .add_external_provider_link(label=True, on_newline=True, text=document_holder.doi)
+            .build()
+        )
+        caption = (
+            f"{short_abstract}\n"
+            f"@{self.related_channel}"
+        )
+        caption_cache[cache_key] = (caption, time.monotonic() + ttl)
+        return caption
+
+    async def send_file(self, **kwargs):
+        for _ in range(2):
+            try:
+                return await self.do_send_file(**kwargs)
+            except (rpcerrorlist.TimeoutError, ValueError):
+                pass
+        return await self.do_send_file(**kwargs)
+
+    async def do_send_file(
         self,
         document_holder,
         download_link,
         file,
         request_context,
         progress_callback=None,
+        file_size=None,
         chat_id=None,
         reply_to=None,
         thumb=None,
+        telegram_client=None,
+        filename=None,
     ):
+        telegram_client = telegram_client or self.application.get_telegram_client(request_context.bot_name)
+        language = request_context.chat['language']
         buttons = []
         if request_context.is_personal_mode() and document_holder.index_alias == 'nexus_science':
             buttons.append(Button.switch_inline(
@@ -244,25 +512,17 @@ class DownloadTask(LongTask):
             ))
         if not buttons:
             buttons = None
-        short_abstract = (
-            document_holder.view_builder(request_context.chat["language"])
-            .add_short_description()
-            .add_external_provider_link(label=True, on_newline=True, text=document_holder.doi)
-            .build()
-        )
-        caption = (
-            f"{short_abstract}\n"
-            f"@{self.application.config['telegram']['related_channel']}"
-        )
-        if self.application.get_telegram_client(request_context.bot_name):
-            filename = document_holder.get_purified_name(download_link) + '.' + download_link['extension']
+        caption = self.get_caption(document_holder, download_link, language)
+        if telegram_client:
+            filename = filename or document_holder.get_purified_name(download_link) + '.' + download_link['extension']
 
-            message = await self.application.get_telegram_client(request_context.bot_name).send_file(
+            message = await telegram_client.send_file(
                 attributes=[DocumentAttributeFilename(filename)],
                 buttons=buttons,
                 caption=caption,
                 entity=chat_id or request_context.chat['chat_id'],
                 file=file,
+                file_size=file_size,
                 progress_callback=progress_callback,
                 reply_to=reply_to,
                 thumb=thumb,
@@ -272,18 +532,38 @@ class DownloadTask(LongTask):
 
 
 class DownloadHandler(BaseCallbackQueryHandler):
-    filter = events.CallbackQuery(pattern='^/d_([A-Za-z0-9_-]+)$')
+    filter = events.CallbackQuery(pattern=re.compile(rb'^/d_([A-Za-z0-9_-]+)$'))
     is_group_handler = True
 
     def parse_pattern(self, event: events.ChatAction):
-        cid = recode_base64_to_base36(event.pattern_match.group(1).decode())
+        cid = recode_base64_to_base36(event.pattern_match.group(1).decode('ascii'))
         return cid
 
+    async def get_document(self, cid, ttl=60.0):
+        cached = document_cache.get(cid)
+        if cached is not None:
+            document, expires_at = cached
+            if time.monotonic() < expires_at:
+                return document
+        document = await self.application.summa_client.get_one_by_field_value('nexus_science', 'links.cid', cid)
+        if document:
+            document_cache[cid] = (document, time.monotonic() + ttl)
+        return document
+
     async def handler(self, event: events.ChatAction, request_context: RequestContext):
         cid = self.parse_pattern(event)
         request_context.add_default_fields(mode='download', cid=cid)
         request_context.statbox(action='get')
-        document = await self.application.summa_client.get_one_by_field_value('nexus_science', 'links.cid', cid)
+        # Limits are checked before the index lookup, clicks for an already running download are answered below
+        if (
+            self.application.user_manager.hit_limits(request_context.chat['chat_id'])
+            and not self.application.user_manager.has_task(request_context.chat['chat_id'], DownloadTask.task_id_for(cid))
+        ):
+            async with safe_execution(is_logging_enabled=False):
+                return await event.answer(
+                    f'{t("TOO_MANY_DOWNLOADS", request_context.chat["language"])}',
+                )
+        document = await self.get_document(cid)
         if not document:
             return await event.answer(
                 f'{t("CID_DISAPPEARED", request_context.chat["language"])}',
@@ -301,11 +581,6 @@ class DownloadHandler(BaseCallbackQueryHandler):
                 )
                 await remove_button(event, '⬇️', and_empty_too=True, link_preview=document_holder.has_cover())
                 return
-        if self.application.user_manager.hit_limits(request_context.chat['chat_id']):
-            async with safe_execution(is_logging_enabled=False):
-                return await event.answer(
-                    f'{t("TOO_MANY_DOWNLOADS", request_context.chat["language"])}',
-                )
         await remove_button(event, '⬇️', and_empty_too=True, link_preview=document_holder.has_cover())
         return DownloadTask(
             application=self.application,
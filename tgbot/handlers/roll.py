@@ -1,3 +1,4 @@
+import asyncio
 import re
 import time
 
@@ -32,7 +33,11 @@ class RollHandler(BaseHandler):
         if documents:
             holder = BaseTelegramDocumentHolder(documents[0])
             promo = self.application.promotioner.choose_promotion(query_traits.query_language)
-            view = holder.view_builder(query_traits.query_language).add_view(bot_name=request_context.bot_name).add_new_line(2).add(promo, escaped=True).build()
+            view = await asyncio.to_thread(
+                lambda: holder.view_builder(query_traits.query_language).add_view(
+                    bot_name=request_context.bot_name,
+                ).add_new_line(2).add(promo, escaped=True).build()
+            )
             buttons_builder = holder.buttons_builder(query_traits.query_language)
 
             if request_context.is_group_mode():
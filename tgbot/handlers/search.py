@@ -51,6 +51,8 @@ def is_doi_query(query: str):
 
 
 class RetrieveTask(LongTask):
+    __slots__ = ('is_upstream', 'ignore_clean_errors')
+
     def __init__(
         self,
         application,
@@ -211,7 +213,9 @@ class BaseSearchHandler(BaseHandler, ABC):
                 await self.application.database.delete_cached_file(holder.cid)
 
             if is_shortpath_enabled:
-                view = holder.view_builder(language).add_new_line(2).add_view(bot_name=request_context.bot_name).build()
+                view = await asyncio.to_thread(
+                    lambda: holder.view_builder(language).add_new_line(2).add_view(bot_name=request_context.bot_name).build()
+                )
                 remote_request_link = None
                 if librarian_service_id:
                     remote_request_link = f'https://t.me/{self.application.librarian_service.group_name}/{librarian_service_id}'
@@ -46,14 +46,17 @@ class ViewHandler(BaseHandler):
                 return await event.reply(t("OUTDATED_VIEW_LINK", language))
             holder = BaseTelegramDocumentHolder(document)
             promo = self.application.promotioner.choose_promotion(language)
-            view_builder = holder.view_builder(language).add_view(bot_name=request_context.bot_name).add_new_line(2).add(promo, escaped=True)
+            # Rendering of abstracts parses HTML and would block the event loop on long documents
+            view = await asyncio.to_thread(
+                lambda: holder.view_builder(language).add_view(bot_name=request_context.bot_name).add_new_line(2).add(promo, escaped=True).build()
+            )
             buttons = holder.buttons_builder(language).add_default_layout(
                 bot_name=request_context.bot_name,
                 is_group_mode=request_context.is_group_mode(),
             ).build()
             return await asyncio.gather(
                 event.delete(),
-                prefetch_message.edit(view_builder.build(), buttons=buttons, link_preview=holder.has_cover()),
+                prefetch_message.edit(view, buttons=buttons, link_preview=holder.has_cover()),
             )
         except MessageIdInvalidError:
             return await event.reply(t("VIEWS_CANNOT_BE_SHARED", language))
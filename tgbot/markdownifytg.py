@@ -1,5 +1,7 @@
+import functools
 import re
 
+from bs4 import BeautifulSoup
 from markdownify import (
     MarkdownConverter,
     abstract_inline_conversion, chomp,
@@ -8,7 +10,14 @@ from markdownify import (
 html_heading_re = re.compile(r'(h[1-6]|header|title)')
 
 
-class Converter(MarkdownConverter):
+class LxmlMarkdownConverter(MarkdownConverter):
+    def convert(self, html):
+        # `lxml` is a C parser and is considerably faster than the default `html.parser`.
+        # Unlike `html.parser` it drops whitespace and comments before the first text node
+        return self.convert_soup(BeautifulSoup(html, 'lxml'))
+
+
+class Converter(LxmlMarkdownConverter):
     convert_b = abstract_inline_conversion(lambda self: '**')
     convert_i = abstract_inline_conversion(lambda self: '__')
     convert_em = abstract_inline_conversion(lambda self: '__')
@@ -42,7 +51,7 @@ class Converter(MarkdownConverter):
         return '🔢\n'
 
 
-class SnippetConverter(MarkdownConverter):
+class SnippetConverter(LxmlMarkdownConverter):
     convert_highlight = abstract_inline_conversion(lambda self: '**')
     convert_i = abstract_inline_conversion(lambda self: '')
     convert_header = abstract_inline_conversion(lambda self: '')
@@ -70,5 +79,15 @@ md_converter = Converter(escape_asterisks=False)
 highlight_md_converter = SnippetConverter(escape_asterisks=False)
 
 
+@functools.lru_cache(maxsize=8)
+def _get_converter(options):
+    return Converter(**dict(options))
+
+
 def md(html, **options):
-    return Converter(**options).convert(html)
+    try:
+        converter = _get_converter(tuple(sorted(options.items())))
+    except TypeError:
+        # Unhashable options (i.e. lists of tags) are not cached
+        converter = Converter(**options)
+    return converter.convert(html)
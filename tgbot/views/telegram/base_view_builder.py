@@ -612,7 +612,7 @@ class BaseViewBuilder:
             abstract += self.document_holder.content or ''
         if abstract:
             text = replace_broken_tags(despace_abstract(abstract or ''))
-            soup = BeautifulSoup(text, 'html.parser')
+            soup = BeautifulSoup(text, 'lxml')
             for tag in list(soup.select('figure, img, [role="note"], .side-box-text, .thumbcaption')):
                 tag.extract()
             for tag in soup.find_all('i'):
@@ -88,7 +88,7 @@ class ProgressBar:
         return False
 
     async def send_message(self, text, ignore_last_call=False):
-        now = time.time()
+        now = time.monotonic()
         if not self.should_send(now, ignore_last_call):
             return
         try: